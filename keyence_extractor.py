@@ -1,16 +1,32 @@
 import xml.etree.ElementTree as ET
-import glob
+import io
 import mmap
 import os
 import re
+import tempfile
 import json
-import unicodedata
 import argparse
+import functools
+import multiprocessing
 import cv2
 import numpy as np
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 ALLOWABLE_CHANNELS = ["CH1", "CH2", "CH3", "CH4", "CH5"]
+_ALLOWABLE_CHANNEL_SET = frozenset(ALLOWABLE_CHANNELS)
+
+# "_<channel>.tif" suffix of a tile filename
+_CHANNEL_RE = re.compile(r"_([^_./\\]+)\.tif$", re.IGNORECASE)
+
+# make sure OpenCV dispatches to its SIMD-optimised code paths
+cv2.setUseOptimized(True)
+
+# get_active_plane() result for tiles with signal in more than one plane
+MIXED_PLANES = -1
+
+# number of tiles decoded ahead of the one being blended
+PREFETCH_TILES = 4
 
 def extract_xml(path):
     """
@@ -20,16 +36,41 @@ def extract_xml(path):
         f (obj): A path to a TIFF file.
     
     Returns:
-        Safe XML string in ASCII encoding
+        UTF-8 encoded XML bytes
     """
-    xml = ""
-    with open(path, "r+") as tif:
-        mm = mmap.mmap(tif.fileno(), 0)
-        midx = mm.find(b"<?xml")
-        xml = mm[midx:].decode('utf-8')
+    xml = b""
+    with open(path, "rb") as tif:
+        with mmap.mmap(tif.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # the metadata block is appended after the image data, so search
+            # backwards from the end instead of scanning the pixels
+            midx = mm.rfind(b"<?xml")
+            xml = mm[midx:]
 
-    # force any unicode character into some decent ASCII approximation
-    return unicodedata.normalize('NFKD', xml).encode('ascii', 'ignore')
+    # handed to the XML parser as-is, which decodes UTF-8 natively
+    return xml
+
+
+def read_elements(xml, tags):
+    """
+    Collects the children of the first element with each of the given tags,
+    stopping the parse as soon as all of them have been seen.
+
+    Args:
+        xml (bytes): XML document.
+        tags: Iterable of element tags to collect.
+
+    Returns:
+        Dictionary keyed on tag of {child tag: child text} dictionaries
+    """
+    needed = set(tags)
+    found = {}
+    for _, elem in ET.iterparse(io.BytesIO(xml), events=("end",)):
+        if elem.tag in needed:
+            found[elem.tag] = {child.tag: child.text for child in elem}
+            needed.discard(elem.tag)
+            if not needed:
+                break
+    return found
 
 
 def position_info(path):
@@ -47,19 +88,22 @@ def position_info(path):
     # grab the hidden XML data from the TIFF file
     xml = extract_xml(path)
 
-    root = ET.fromstring(xml)
+    # only two small elements are needed, so don't build the whole tree
+    elements = read_elements(xml, ("OriginalImageSize", "XyStageRegion"))
+    orig_image_size = elements.get("OriginalImageSize")
+    xystageregion = elements.get("XyStageRegion")
+    if orig_image_size is None or xystageregion is None:
+        raise ValueError("Improper XML format in TIFF file.")
 
     try:
-        orig_image_size = next(root.iter("OriginalImageSize"))
-        orig_width = int(orig_image_size.find("Width").text)
-        orig_height = int(orig_image_size.find("Height").text)
-
-        xystageregion = next(root.iter("XyStageRegion"))
-        x = int(xystageregion.find('X').text)
-        y = int(xystageregion.find('Y').text)
-        unscaled_height = int(xystageregion.find('Height').text)
-        unscaled_width = int(xystageregion.find('Width').text)
-    except ValueError:
+        orig_width = int(orig_image_size.get("Width"))
+        orig_height = int(orig_image_size.get("Height"))
+
+        x = int(xystageregion.get('X'))
+        y = int(xystageregion.get('Y'))
+        unscaled_height = int(xystageregion.get('Height'))
+        unscaled_width = int(xystageregion.get('Width'))
+    except (TypeError, ValueError):
         raise ValueError("Improper XML format in TIFF file.")
 
     width_scaling_factor = float(orig_width) / unscaled_width
@@ -83,54 +127,194 @@ def fix_origin(corner_dict):
         Origin corrected dictionary of tile image positions
     """
 
-    x_origin = max([corner_dict[k][0] for k in corner_dict.keys()])
-    y_origin = max([corner_dict[k][1] for k in corner_dict.keys()])
+    keys = list(corner_dict.keys())
+    corners = np.array([corner_dict[k] for k in keys])
+    corrected = corners.max(axis=0) - corners
 
-    return {
-        k:
-        (int(x_origin - corner_dict[k][0]), int(y_origin - corner_dict[k][1]))
-        for k in corner_dict.keys()
-    }
+    return {k: (int(x), int(y)) for k, (x, y) in zip(keys, corrected)}
 
 
 def get_stitching(file_list):
     corner_dict = {}
     size_dict = {}
-    for f in file_list:
-        corner, size = position_info(f) 
-        corner_dict[f] = corner
-        size_dict[f] = size
+    # each tile's metadata is read independently, so overlap the file reads
+    with ThreadPoolExecutor() as ex:
+        for f, (corner, size) in zip(file_list, ex.map(position_info, file_list)):
+            corner_dict[f] = corner
+            size_dict[f] = size
     corner_dict = fix_origin(corner_dict)
     return corner_dict, size_dict
 
 def get_blended_size(file_lst, corner_dict, size_dict):
     assert len(file_lst) > 0
-    max_x_key = file_lst[0]
-    max_y_key = file_lst[0]
-    for f in file_lst:
-        if (corner_dict[f][0] > corner_dict[max_x_key][0]):
-            max_x_key = f
+    corners = np.array([corner_dict[f] for f in file_lst])
+    sizes = np.array([size_dict[f] for f in file_lst])
+    width, height = (corners + sizes).max(axis=0)
 
-        if (corner_dict[f][1] > corner_dict[max_y_key][1]):
-            max_y_key = f
-    
-    return (corner_dict[max_x_key][0] + size_dict[max_x_key][0], corner_dict[max_y_key][1] + size_dict[max_y_key][1])
+    return (int(width), int(height))
 
-def blend(file_lst, outpath, corner_dict, size_dict, channels=1):
+def get_active_plane(im):
+    """
+    Finds the colour plane that holds the signal of a Keyence tile.
+
+    Args:
+        im: A (height, width, planes) tile as returned by cv2.imread.
+
+    Returns:
+        Index of the only non-zero plane, MIXED_PLANES if several planes
+        hold signal, or None if the tile is blank and nothing can be decided
+    """
+    # sum every pixel: fluorescence signal can be a few small spots, and this
+    # only runs until one tile of the channel has shown its plane
+    populated = np.flatnonzero(im.reshape(-1, im.shape[2]).sum(axis=0))
+    if len(populated) == 0:
+        return None
+    if len(populated) > 1:
+        return MIXED_PLANES
+    return int(populated[0])
+
+def allocate_canvas(shape, dtype, low_memory=False):
+    """
+    Allocates a zero-filled mosaic-sized array.
+
+    Args:
+        shape: (height, width) of the canvas.
+        dtype: NumPy dtype of the canvas.
+        low_memory: Back the canvas with an anonymous temporary file so the
+            OS can page it out instead of holding it all in RAM. True uses
+            the default temporary directory (which may itself be a RAM-backed
+            tmpfs); a string names the directory to use instead.
+
+    Returns:
+        A zeroed ndarray (or np.memmap when low_memory is set)
+    """
+    if not low_memory:
+        return np.zeros(shape=shape, dtype=dtype)
+    scratch_dir = low_memory if isinstance(low_memory, str) else None
+    # the mapping outlives the file object, and the file is removed on close
+    with tempfile.TemporaryFile(dir=scratch_dir) as scratch:
+        return np.memmap(scratch, dtype=dtype, mode="w+", shape=shape)
+
+def feather_weights(size):
+    """
+    Builds a separable tent weighting for a tile, highest in the centre and
+    falling off linearly towards the edges.
+
+    Args:
+        size: (width, height) of the tile.
+
+    Returns:
+        (height, width) float32 array of weights in (0, 1]
+    """
+    width, height = size
+    # drop the endpoints of the ramp so edge pixels keep a small weight
+    wx = 1 - np.abs(np.linspace(-1, 1, width + 2, dtype=np.float32)[1:-1])
+    wy = 1 - np.abs(np.linspace(-1, 1, height + 2, dtype=np.float32)[1:-1])
+    return np.outer(wy, wx)
+
+def scanline_order(file_lst, corner_dict, size_dict):
+    """
+    Orders tiles row by row across the grid, left to right within a row.
+
+    Args:
+        file_lst: Tile paths to order.
+        corner_dict: Top-left corner of each tile, keyed on path.
+        size_dict: (width, height) of each tile, keyed on path.
+
+    Returns:
+        List of the tile paths in scanline order
+    """
+    rows = []
+    prev_y = None
+    for f in sorted(file_lst, key=lambda f: corner_dict[f][1]):
+        y = corner_dict[f][1]
+        # tiles overlap and the stage jitters, so a grid row starts wherever
+        # y jumps by more than half a tile rather than at a fixed pitch
+        if prev_y is None or y - prev_y > size_dict[f][1] / 2:
+            rows.append([])
+        rows[-1].append(f)
+        prev_y = y
+    return [f for row in rows for f in sorted(row, key=lambda f: corner_dict[f][0])]
+
+def blend(file_lst, outpath, corner_dict, size_dict, channels=1, low_memory=False,
+          dtype=np.uint16, feather=False):
     """
     Blend files through by averaging overlaps
+
+    Passing dtype=np.uint8 writes an 8-bit mosaic rescaled from the tiles'
+    range, which is half the size but only suitable for viewing. With
+    feather set, overlaps are a weighted mean that favours each tile's
+    centre, which hides the seams a plain mean leaves at tile edges.
     """
     full_size = get_blended_size(file_lst, corner_dict, size_dict)
-    output = np.zeros(shape=(full_size[1], full_size[0]), dtype=np.uint16)
-    # logger.debug("Blend output size {}".format(output.shape))
-    for f in file_lst:
-        im = None
-        im = cv2.imread(f, -1)
-        im = np.sum(im, axis=2)
-        corner = corner_dict[f]
-        size = size_dict[f]
-        output[corner[1]:corner[1] + size[1], corner[0]:corner[0] + size[0]] = (output[corner[1]:corner[1] + size[1], corner[0]:corner[0] + size[0]] + im) / 2
-    cv2.imwrite(outpath, output)
+    shape = (full_size[1], full_size[0])
+    # per-pixel sum of tile values and total weight of the tiles covering
+    # each pixel (a plain count unless feathering); the mean is taken once
+    # after all tiles are added
+    if feather:
+        accum = allocate_canvas(shape, np.float32, low_memory)
+        weight = allocate_canvas(shape, np.float32, low_memory)
+        ramps = {}
+    else:
+        accum = allocate_canvas(shape, np.int32, low_memory)
+        weight = allocate_canvas(shape, np.uint8, low_memory)
+    # logger.debug("Blend output size {}".format(accum.shape))
+    # paint in row-major order so consecutive tiles touch neighbouring rows
+    # of the canvas rather than jumping around it
+    file_lst = scanline_order(file_lst, corner_dict, size_dict)
+    # decode upcoming tiles in background threads while the current one is
+    # blended; cv2.imread releases the GIL
+    with ThreadPoolExecutor(max_workers=PREFETCH_TILES) as ex:
+        pending = deque(ex.submit(cv2.imread, f, -1) for f in file_lst[:PREFETCH_TILES])
+        plane = None
+        tile_dtype = None
+        for idx, f in enumerate(file_lst):
+            im = pending.popleft().result()
+            if idx + PREFETCH_TILES < len(file_lst):
+                pending.append(ex.submit(cv2.imread, file_lst[idx + PREFETCH_TILES], -1))
+            if tile_dtype is None:
+                tile_dtype = im.dtype
+            # a fluorescence channel populates one colour plane, the same for
+            # every tile, so once a tile with signal shows which one, take a
+            # view of it; until then (blank tiles), or if several planes carry
+            # signal, reduce with max; single-channel tiles are used as-is
+            if im.ndim == 3:
+                if plane is None:
+                    plane = get_active_plane(im)
+                if plane is None or plane == MIXED_PLANES:
+                    im = im.max(axis=2)
+                else:
+                    im = im[:, :, plane]
+            corner = corner_dict[f]
+            size = size_dict[f]
+            rows = slice(corner[1], corner[1] + size[1])
+            cols = slice(corner[0], corner[0] + size[0])
+            section = accum[rows, cols]
+            if feather:
+                if size not in ramps:
+                    ramps[size] = feather_weights(size)
+                cv2.accumulateProduct(im.astype(np.float32), ramps[size], section)
+                cv2.accumulate(ramps[size], weight[rows, cols])
+            else:
+                # widen to int32 inside OpenCV's add and write straight into the view
+                cv2.add(section, im, dst=section, dtype=cv2.CV_32S)
+                weight[rows, cols] += 1
+    if feather:
+        # uncovered pixels have a zero sum; keep their weight non-zero so the
+        # division below gives 0 there rather than NaN
+        np.maximum(weight, np.finfo(np.float32).tiny, out=weight)
+    if np.dtype(dtype) == np.uint8:
+        depth = cv2.CV_8U
+        scale = 255.0 / np.iinfo(tile_dtype).max
+    else:
+        depth = cv2.CV_16U
+        scale = 1.0
+    output = allocate_canvas(shape, dtype, low_memory)
+    # integer division by a zero count gives 0 for uncovered pixels
+    cv2.divide(accum, weight, dst=output, scale=scale, dtype=depth)
+    # write uncompressed (libtiff COMPRESSION_NONE) rather than OpenCV's
+    # default LZW, which dominates write time on large mosaics
+    cv2.imwrite(outpath, output, [cv2.IMWRITE_TIFF_COMPRESSION, 1])
 
 
 def get_channel_lists(file_lst):
@@ -140,10 +324,9 @@ def get_channel_lists(file_lst):
     """
     channels = defaultdict(list)
     for f in file_lst:
-        fields = f.split("_")[-1].split(".")
-        
-        if (len(fields) == 2 and fields[0] in ALLOWABLE_CHANNELS and (fields[1] == "TIF" or fields[1] == "tif")):
-            channels[fields[0]].append(f)
+        m = _CHANNEL_RE.search(f)
+        if m and m.group(1) in _ALLOWABLE_CHANNEL_SET:
+            channels[m.group(1)].append(f)
     return channels
 
 def dir_path(d):
@@ -157,6 +340,25 @@ def dir_path(d):
     else:
         raise NotADirectoryError(d)
 
+def positive_int(n):
+    """ Verifies that a command line count is a positive integer.
+
+    Args:
+        n: A string representing the count.
+    """
+    value = int(n)
+    if value < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: {}".format(n))
+    return value
+
+def init_blend_worker(num_threads):
+    """ Caps OpenCV's internal thread pool in a blending worker process.
+
+    Args:
+        num_threads: Number of threads OpenCV may use in this process.
+    """
+    cv2.setNumThreads(num_threads)
+
 def output_stitching(corners, path):
     with open(path, 'w') as f:
         f.write(json.dumps(corners))
@@ -170,18 +372,62 @@ def main():
         type=dir_path,
         help="Path containing images to be analyzed",
         required=True)
+    parser.add_argument(
+        '--low-memory',
+        dest="LOW_MEMORY",
+        nargs="?",
+        const=True,
+        default=False,
+        type=dir_path,
+        metavar="DIR",
+        help="Keep blending buffers in temporary files under DIR instead of "
+             "RAM (default DIR: the system temp dir, which is RAM-backed on "
+             "systems where it is a tmpfs)")
+    parser.add_argument(
+        '--8bit',
+        dest="EIGHT_BIT",
+        action="store_true",
+        help="Write 8-bit mosaics for viewing (not for quantification)")
+    parser.add_argument(
+        '--feather',
+        dest="FEATHER",
+        action="store_true",
+        help="Feather tile overlaps instead of taking a plain mean")
+    parser.add_argument(
+        '--processes',
+        dest="PROCESSES",
+        type=positive_int,
+        default=1,
+        help="Number of channels to blend at once; each holds its own "
+             "mosaic-sized buffers, so peak memory grows with this (default: 1)")
 
     args = parser.parse_args()
-    file_lst = glob.glob(args.IMAGE_DIR + "/*.tif")
+    with os.scandir(args.IMAGE_DIR) as it:
+        file_lst = [entry.path for entry in it if entry.name.lower().endswith(".tif")]
     channels = get_channel_lists(file_lst) 
     verified_files = [item for sublist in channels.values() for item in sublist]
     corners, size = get_stitching(verified_files)
     output_stitching(corners, "stitching.json")
     print("Outputted stitching positions to stitching.json")
+    jobs = []
     for channel in channels:
         path = channel + "_stitched.tif"
         print("Outputting blended {channel} to {path}.".format(channel=channel, path=path))
-        blend(channels[channel], path, corners, size)
+        jobs.append((channels[channel], path, corners, size))
+
+    # channels are independent, so blend up to --processes of them at once
+    # and split the cores between them so OpenCV's threads don't oversubscribe
+    cpus = os.cpu_count() or 1
+    processes = max(1, min(len(jobs), args.PROCESSES))
+    with multiprocessing.Pool(processes=processes,
+                              initializer=init_blend_worker,
+                              initargs=(max(1, cpus // processes),)) as pool:
+        pool.starmap(functools.partial(blend,
+                                       low_memory=args.LOW_MEMORY,
+                                       dtype=np.uint8 if args.EIGHT_BIT else np.uint16,
+                                       feather=args.FEATHER), jobs)
+    for channel in channels:
+        path = channel + "_stitched.tif"
         print("Outputted blended {channel} to {path}.".format(channel=channel, path=path))
 
 if __name__ == "__main__":